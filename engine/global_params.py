@@ -7,9 +7,64 @@ TOKEN = <bot token>
 POLL_INTERVAL = 2.0
 MAINT_ID = <ID of maintenance chat>
 
+# Dispatcher parameters
+WORKERS = 4
+CHAT_QUEUE_SIZE = 16
+DB_POOL_TIMEOUT = 10
+
+# Shutdown parameters
+SHUTDOWN_DEADLINE = 20.0
+
+# Bot API client parameters
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 5.0
+METHOD_TIMEOUTS = {
+    "getChatMember": 3.0,
+    "deleteMessage": 3.0,
+    "pinChatMessage": 3.0,
+    "editMessageReplyMarkup": 3.0,
+    "answerCallbackQuery": 2.0
+}
+MAX_RETRIES = 3
+MAX_RETRY_AFTER = 30
+RETRY_BACKOFF = 0.5
+RETRY_BUDGET = 20
+RETRY_BUDGET_PERIOD = 60.0
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+NON_CRITICAL_METHODS = ["deleteMessage", "pinChatMessage", "editMessageReplyMarkup"]
+DEFERRED_QUEUE_SIZE = 100
+
+# Broadcast parameters
+DEAD_CHAT_FAILURES = 3
+
+# Update journal parameters
+JOURNAL_RETENTION = 3600
+JOURNAL_PRUNE_INTERVAL = 60
+REPLAY_MAX_AGE = 300
+
+# Inline mode parameters
+INLINE_CACHE_TIME = 300
+
+# Tracing parameters
+TRACING = False
+TRACE_THRESHOLD = 1.0
+TRACE_FILE = "oubot_traces.jsonl"
+TRACE_FILE_SIZE = 10 * 1024 * 1024
+TRACE_FILE_COUNT = 5
+PROFILE_SAMPLE_RATE = 0.2
+PROFILE_DIR = "."
+
 # SQLite3 parameters
 DB_NAME = "engine/sqlite/oubot.sqlite3"
 
+# Multi-bot parameters: if not empty, TOKEN, MAINT_ID and DB_NAME above are ignored
+BOTS = []
+# BOTS = [
+#     {"TOKEN": <bot token>, "MAINT_ID": <ID of maintenance chat>, "DB_NAME": "engine/sqlite/oubot.sqlite3"},
+#     {"TOKEN": <bot token>, "MAINT_ID": <ID of maintenance chat>, "DB_NAME": "engine/sqlite/other.sqlite3"}
+# ]
+
 # Webhook params
 # PUBLIC_IP = <public IP>
 # LISTEN_IP = <private IP>
@@ -1,12 +1,58 @@
-from typing import List
-from peewee import SqliteDatabase, Model, IntegerField, IntegrityError
-from ..global_params import DB_NAME
+from contextlib import contextmanager
+from time import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from peewee import SqliteDatabase, Model, IntegerField, IntegrityError, TextField, JOIN
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.shortcuts import ThreadSafeDatabaseMetadata
+from ..global_params import WORKERS, DB_POOL_TIMEOUT, DEAD_CHAT_FAILURES
+from ..tracing import span
 
 import logging
 
+
+class TracedSqliteDatabase(PooledSqliteDatabase):
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        # Statement is recorded without parameters
+        with span("db", sql[:80]):
+            return super().execute_sql(sql, params, *args, **kwargs)
+
+
+"""Threads besides workers that might hold a connection: dispatcher, update intake (polling or webhook), job queue and
+main thread (startup and shutdown)"""
+NON_WORKER_CONNECTIONS = 4
+
+
+def open_database(db_name: str) -> SqliteDatabase:
+    """ Create connection pool for DB file
+
+    Pool has a connection for every thread that might hold one; if it is exhausted anyway, threads wait for a free one.
+
+    :param db_name: path to SQLite DB file
+    :return: pooled database
+    """
+    return TracedSqliteDatabase(db_name, max_connections=WORKERS + NON_WORKER_CONNECTIONS, timeout=DB_POOL_TIMEOUT,
+                                check_same_thread=False)
+
+
+class ThreadLocalDatabaseMetadata(ThreadSafeDatabaseMetadata):
+    """ Model metadata that keeps DB binding per thread only
+
+    ThreadSafeDatabaseMetadata falls back to the first DB ever bound in threads without binding, which would be DB of
+    an arbitrary bot. Here threads without binding see no DB, so that queries fail instead.
+    """
+
+    def _set_db(self, database: Optional[SqliteDatabase]) -> None:
+        self._local.database = database
+
+    database = property(ThreadSafeDatabaseMetadata._get_db, _set_db)
+
+
 class BaseModel(Model):
     class Meta:
-        database = SqliteDatabase(DB_NAME)
+        # Not bound by default: every bot binds its own DB per thread, so that missing binding fails instead of
+        # silently using DB of another bot
+        database = None
+        model_metadata_class = ThreadLocalDatabaseMetadata
 
 
 class TgGroupBalance(BaseModel):
@@ -19,6 +65,55 @@ class TgGroupParams(BaseModel):
     hour_fee = IntegerField()
 
 
+class TgUpdateJournal(BaseModel):
+    update_id = IntegerField(unique=True)
+    payload = TextField()
+    received = IntegerField()
+    done = IntegerField(default=0)
+
+
+class TgAppliedUpdate(BaseModel):
+    update_id = IntegerField(unique=True)
+    applied = IntegerField()
+
+
+class TgDeadChat(BaseModel):
+    chat_id = IntegerField(unique=True)
+    failures = IntegerField()
+    reason = TextField()
+
+
+class TgGroupTitle(BaseModel):
+    chat_id = IntegerField(unique=True)
+    title = TextField()
+
+
+class TgGroupMember(BaseModel):
+    chat_id = IntegerField()
+    user_id = IntegerField()
+
+    class Meta:
+        indexes = ((("chat_id", "user_id"), True),)
+
+
+MODELS = [TgGroupBalance, TgGroupParams, TgUpdateJournal, TgAppliedUpdate, TgDeadChat, TgGroupTitle, TgGroupMember]
+
+
+@contextmanager
+def use_database(database: SqliteDatabase) -> Iterator[None]:
+    """ Bind models to the database for the current thread and hold a pooled connection
+
+    :param database: database returned by open_database
+    """
+    with database.bind_ctx(MODELS):
+        # Nested usage keeps connection of the outer context open
+        if database.is_closed():
+            with database.connection_context():
+                yield
+        else:
+            yield
+
+
 def add_group(chat_id: int) -> bool:
     try:
         TgGroupParams.create(chat_id=chat_id)
@@ -37,18 +132,37 @@ def get_balance(chat_id: int) -> int:
     return TgGroupBalance.get(TgGroupBalance.chat_id == chat_id).balance
 
 
-def add_balance(chat_id: int, deposit: int) -> int:
-    entity = TgGroupBalance.get(TgGroupBalance.chat_id == chat_id)
-    entity.balance = entity.balance + deposit
-    entity.save()
-    return entity.balance
+def _mark_applied(update_id: Optional[int]) -> bool:
+    """ Store idempotency marker of the update, to be called within balance mutation transaction
 
+    :param update_id: Telegram update ID that caused mutation
+    :return: False if the update has already been applied
+    """
+    if update_id is None:
+        return True
+    if TgAppliedUpdate.select().where(TgAppliedUpdate.update_id == update_id).exists():
+        logging.warning(f"Update {update_id} has already been applied, skipping")
+        return False
+    TgAppliedUpdate.create(update_id=update_id, applied=int(time()))
+    return True
+
+
+def add_balance(chat_id: int, deposit: int, update_id: Optional[int] = None) -> int:
+    with TgGroupBalance._meta.database.atomic():
+        entity = TgGroupBalance.get(TgGroupBalance.chat_id == chat_id)
+        if _mark_applied(update_id):
+            entity.balance = entity.balance + deposit
+            entity.save()
+        return entity.balance
 
-def use_balance(chat_id: int, spent: int) -> int:
-    entity = TgGroupBalance.get(TgGroupBalance.chat_id == chat_id)
-    entity.balance = entity.balance - spent
-    entity.save()
-    return entity.balance
+
+def use_balance(chat_id: int, spent: int, update_id: Optional[int] = None) -> int:
+    with TgGroupBalance._meta.database.atomic():
+        entity = TgGroupBalance.get(TgGroupBalance.chat_id == chat_id)
+        if _mark_applied(update_id):
+            entity.balance = entity.balance - spent
+            entity.save()
+        return entity.balance
 
 
 def get_hour_fee(chat_id: int) -> int:
@@ -62,4 +176,123 @@ def set_hour_fee(chat_id: int, hour_fee: int) -> None:
 
 
 def get_groups() -> List[int]:
-    return [x.chat_id for x in TgGroupParams.select()]
+    """ Authorized groups except dead ones (bot is kicked or chat is not found) """
+    dead = TgDeadChat.select(TgDeadChat.chat_id).where(TgDeadChat.failures >= DEAD_CHAT_FAILURES)
+    return [x.chat_id for x in TgGroupParams.select().where(TgGroupParams.chat_id.not_in(dead))]
+
+
+def migrate_group(old_chat_id: int, new_chat_id: int) -> bool:
+    """ Move group data to new chat ID once group is converted to supergroup
+
+    :param old_chat_id: chat ID of the group
+    :param new_chat_id: chat ID of the supergroup
+    :return: True if data is moved, False if already moved or new chat ID is taken
+    """
+    try:
+        with TgGroupParams._meta.database.atomic():
+            moved = TgGroupParams.update(chat_id=new_chat_id).where(TgGroupParams.chat_id == old_chat_id).execute()
+            TgGroupBalance.update(chat_id=new_chat_id).where(TgGroupBalance.chat_id == old_chat_id).execute()
+            TgGroupTitle.update(chat_id=new_chat_id).where(TgGroupTitle.chat_id == old_chat_id).execute()
+            TgGroupMember.update(chat_id=new_chat_id).where(TgGroupMember.chat_id == old_chat_id).execute()
+            TgDeadChat.delete().where(TgDeadChat.chat_id == old_chat_id).execute()
+            return moved > 0
+    except IntegrityError as e:
+        logging.warning(f"Migrating chat {old_chat_id} to {new_chat_id} failed: {e}")
+        return False
+
+
+def get_failing_chats() -> List[int]:
+    return [x.chat_id for x in TgDeadChat.select()]
+
+
+def record_chat_failure(chat_id: int, reason: str) -> None:
+    TgDeadChat.insert(chat_id=chat_id, failures=1, reason=reason) \
+        .on_conflict(conflict_target=[TgDeadChat.chat_id],
+                     update={TgDeadChat.failures: TgDeadChat.failures + 1, TgDeadChat.reason: reason}) \
+        .execute()
+
+
+def revive_chat(chat_id: int) -> None:
+    TgDeadChat.delete().where(TgDeadChat.chat_id == chat_id).execute()
+
+
+def get_group_summaries() -> Dict[int, Tuple[Optional[str], int, int]]:
+    """ Title (if known), balance and hour fee per authorized group """
+    query = (TgGroupParams
+             .select(TgGroupParams.chat_id, TgGroupTitle.title, TgGroupBalance.balance, TgGroupParams.hour_fee)
+             .join(TgGroupBalance, on=(TgGroupParams.chat_id == TgGroupBalance.chat_id))
+             .join(TgGroupTitle, JOIN.LEFT_OUTER, on=(TgGroupParams.chat_id == TgGroupTitle.chat_id))
+             .tuples())
+    return {chat_id: (title, balance, hour_fee) for chat_id, title, balance, hour_fee in query}
+
+
+def set_group_title(chat_id: int, title: str) -> None:
+    TgGroupTitle.insert(chat_id=chat_id, title=title) \
+        .on_conflict(conflict_target=[TgGroupTitle.chat_id], update={TgGroupTitle.title: title}) \
+        .execute()
+
+
+def get_group_members() -> Dict[int, Set[int]]:
+    """ Groups per user seen in them """
+    members = {}
+    for x in TgGroupMember.select():
+        members.setdefault(x.user_id, set()).add(x.chat_id)
+    return members
+
+
+def add_group_member(chat_id: int, user_id: int) -> None:
+    TgGroupMember.insert(chat_id=chat_id, user_id=user_id).on_conflict_ignore().execute()
+
+
+def remove_group_member(chat_id: int, user_id: int) -> None:
+    TgGroupMember.delete().where((TgGroupMember.chat_id == chat_id) & (TgGroupMember.user_id == user_id)).execute()
+
+
+def journal_update(update_id: int, payload: str) -> bool:
+    """ Store incoming update before it is processed
+
+    :param update_id: Telegram update ID
+    :param payload: update serialized to JSON
+    :return: False if the update is already journaled (delivered twice)
+    """
+    try:
+        TgUpdateJournal.create(update_id=update_id, payload=payload, received=int(time()))
+        return True
+    except IntegrityError:
+        return False
+
+
+def complete_update(update_id: int) -> None:
+    TgUpdateJournal.update(done=1).where(TgUpdateJournal.update_id == update_id).execute()
+
+
+def get_unfinished_updates(max_age: int) -> List[str]:
+    """ Get updates interrupted by restart; older updates are abandoned as user does not expect them anymore
+
+    :param max_age: seconds
+    :return: updates serialized to JSON in order of receipt
+    """
+    before = int(time()) - max_age
+    with TgUpdateJournal._meta.database.atomic():
+        stale = TgUpdateJournal.update(done=1).where((TgUpdateJournal.done == 0) &
+                                                     (TgUpdateJournal.received < before)).execute()
+        if stale:
+            logging.warning(f"{stale} unfinished updates are older than {max_age}s, abandoned")
+        query = TgUpdateJournal.select().where(TgUpdateJournal.done == 0).order_by(TgUpdateJournal.update_id)
+        return [x.payload for x in query]
+
+
+def prune_journal(retention: int) -> None:
+    """ Remove processed updates and idempotency markers older than retention period
+
+    Both are kept for a while to detect updates delivered again by Telegram after restart. Markers of updates that
+    are still unfinished are kept, otherwise replay would apply balance change once again.
+
+    :param retention: seconds
+    """
+    before = int(time()) - retention
+    unfinished = TgUpdateJournal.select(TgUpdateJournal.update_id).where(TgUpdateJournal.done == 0)
+    with TgUpdateJournal._meta.database.atomic():
+        TgUpdateJournal.delete().where((TgUpdateJournal.done == 1) & (TgUpdateJournal.received < before)).execute()
+        TgAppliedUpdate.delete().where((TgAppliedUpdate.applied < before) &
+                                       TgAppliedUpdate.update_id.not_in(unfinished)).execute()
@@ -0,0 +1,228 @@
+from collections import deque
+from functools import partial
+from time import monotonic
+from typing import Callable, Deque, Dict, Hashable, List, Optional
+
+import engine.sqlite.database as db
+import engine.tracing as tracing
+import json
+import logging
+
+from peewee import SqliteDatabase
+from queue import Queue
+from telegram import Update
+from telegram.ext import Dispatcher
+from threading import Condition, Thread
+
+"""Updates that cannot change state, they are neither journaled nor replayed"""
+UNJOURNALED_UPDATES = ("inline_query", "chosen_inline_result")
+
+"""Results of KeyedExecutor.submit"""
+(
+    SUBMIT_ACCEPTED,
+    SUBMIT_QUEUE_FULL,
+    SUBMIT_STOPPED
+) = range(0, 3)
+
+
+class KeyedExecutor:
+    """ Thread pool that runs tasks sharing the same key strictly in submission order
+
+    Tasks with different keys are run in parallel by the pool. Ready keys are served round-robin, one task per
+    turn, so a key with a long backlog cannot starve the others. Backlog per key is bounded by queue_size.
+    """
+
+    def __init__(self, workers: int, queue_size: int, name: str = "keyed_executor"):
+        self._workers = workers
+        self._queue_size = queue_size
+        self._name = name
+        self._lock = Condition()
+        # Pending tasks per key; key is present while it is either waiting in ready queue or being processed
+        self._queues: Dict[Hashable, Deque[Callable]] = {}
+        # Keys that have pending tasks and are not being processed by any worker
+        self._ready: Deque[Hashable] = deque()
+        self._threads: List[Thread] = []
+        self._running = False
+
+    def start(self) -> None:
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+
+        for i in range(self._workers):
+            thread = Thread(target=self._worker, name=f"{self._name}_{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key: Hashable, fn: Callable, *args, **kwargs) -> int:
+        """ Enqueue task for the key
+
+        :param key: tasks with the same key are executed sequentially
+        :param fn: callable to be executed
+        :return: SUBMIT_ACCEPTED, or reason the task is dropped: SUBMIT_QUEUE_FULL or SUBMIT_STOPPED
+        """
+        with self._lock:
+            if not self._running:
+                logging.warning(f"{self._name} is stopped, task for {key} is dropped")
+                return SUBMIT_STOPPED
+
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+                self._ready.append(key)
+                self._lock.notify()
+            elif len(queue) >= self._queue_size:
+                logging.warning(f"{self._name} queue for {key} is full, task is dropped")
+                return SUBMIT_QUEUE_FULL
+
+            queue.append(partial(fn, *args, **kwargs))
+            return SUBMIT_ACCEPTED
+
+    def shutdown(self, wait: bool = True, timeout: Optional[float] = None) -> bool:
+        """ Stop accepting new tasks; workers exit once all pending tasks are processed
+
+        :param wait: block until all workers exit
+        :param timeout: maximum time to wait for workers, seconds (unlimited if None)
+        :return: True if all pending tasks are processed
+        """
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+
+        if wait:
+            deadline = None if timeout is None else monotonic() + timeout
+            for thread in self._threads:
+                thread.join(None if deadline is None else max(0.0, deadline - monotonic()))
+
+        with self._lock:
+            pending = sum(len(queue) for queue in self._queues.values())
+            busy = len(self._queues)
+        if busy:
+            logging.warning(f"{self._name} stopped with {pending} pending tasks for {busy} keys")
+        return not busy
+
+    def _next_task(self) -> Optional[tuple]:
+        with self._lock:
+            while not self._ready:
+                if not self._running:
+                    return None
+                self._lock.wait()
+
+            key = self._ready.popleft()
+            return key, self._queues[key].popleft()
+
+    def _worker(self) -> None:
+        while True:
+            item = self._next_task()
+            if item is None:
+                return
+
+            key, task = item
+            try:
+                task()
+            except Exception:
+                logging.exception(f"Task for {key} failed in {self._name}")
+
+            with self._lock:
+                # Put key at the end of ready queue so that other keys are served before its next task
+                if self._queues[key]:
+                    self._ready.append(key)
+                    self._lock.notify()
+                else:
+                    del self._queues[key]
+
+
+def is_journaled(update: Update) -> bool:
+    return all(getattr(update, field) is None for field in UNJOURNALED_UPDATES)
+
+
+class JournalingQueue(Queue):
+    """ Update queue that journals updates in the thread receiving them
+
+    Update is journaled before it is acknowledged to Telegram: webhook response is sent and polling offset is
+    confirmed only after put() returns. Updates delivered twice by Telegram are skipped.
+    """
+
+    def __init__(self, database: SqliteDatabase):
+        super().__init__()
+        self.database = database
+
+    def put(self, item: object, block: bool = True, timeout: Optional[float] = None) -> None:
+        if isinstance(item, Update) and is_journaled(item):
+            try:
+                with db.use_database(self.database):
+                    if not db.journal_update(item.update_id, item.to_json()):
+                        logging.info(f"Update {item.update_id} has already been received, skipping")
+                        return
+            except Exception:
+                # Receiving thread must survive DB failure, update is processed without journaling then
+                logging.exception(f"Journaling update {item.update_id} failed")
+        super().put(item, block, timeout)
+
+
+class ChatDispatcher(Dispatcher):
+    """ Dispatcher that processes updates via KeyedExecutor keyed by chat
+
+    Updates from the same chat are processed in order they are received, updates from different chats are processed
+    in parallel. Updates without chat are keyed by user; the rest are processed in dispatcher thread. Executor might
+    be shared by several bots, so keys are qualified by bot; DB of the bot is bound while update is processed.
+
+    Every update that might change state is journaled by JournalingQueue and marked as done once processed, so that
+    updates interrupted by crash are replayed on startup.
+    """
+
+    def __init__(self, *args, executor: KeyedExecutor, database: SqliteDatabase, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = executor
+        self.database = database
+        # Bot token starts with bot ID, which is sufficient to tell bots apart
+        self.bot_id = self.bot.token.split(':')[0]
+
+    def update_key(self, update: Update) -> Optional[Hashable]:
+        if update.effective_chat is not None:
+            return self.bot_id, update.effective_chat.id
+        if update.effective_user is not None:
+            return self.bot_id, update.effective_user.id
+        return None
+
+    def process_update(self, update: object) -> None:
+        if isinstance(update, Update):
+            self._submit(update)
+            return
+
+        with db.use_database(self.database):
+            super().process_update(update)
+
+    def replay_journal(self, max_age: int) -> None:
+        """ Process updates that were received but not processed before restart
+
+        :param max_age: updates received earlier than max_age seconds ago are not replayed
+        :return: null
+        """
+        with db.use_database(self.database):
+            payloads = db.get_unfinished_updates(max_age)
+
+        if payloads:
+            logging.warning(f"Replaying {len(payloads)} unfinished updates of bot {self.bot_id}")
+        for payload in payloads:
+            self._submit(Update.de_json(json.loads(payload), self.bot))
+
+    def _submit(self, update: Update) -> None:
+        key = self.update_key(update)
+        if key is None:
+            self._process_update(update)
+            return
+        # Update dropped due to full queue is never replayed, otherwise it might be applied long after newer updates
+        # of the chat; update dropped due to shutdown stays unfinished and is replayed on startup
+        if self.executor.submit(key, self._process_update, update) == SUBMIT_QUEUE_FULL and is_journaled(update):
+            with db.use_database(self.database):
+                db.complete_update(update.update_id)
+
+    def _process_update(self, update: Update) -> None:
+        with db.use_database(self.database), tracing.trace_update(update.update_id, self.bot_id):
+            try:
+                super().process_update(update)
+            finally:
+                if is_journaled(update):
+                    db.complete_update(update.update_id)
@@ -1,15 +1,27 @@
-from typing import Union, List, Tuple
+from typing import Union, List, Tuple, Optional, Iterable
 
 import engine.tg.tg_messages as msgs
 import engine.sqlite.database as db
+import engine.tracing as tracing
 import logging
+import os
+import warnings
 
 from engine import global_params
-from telegram import Update, ChatMember, InlineKeyboardMarkup, InlineKeyboardButton
+from engine.tg.tg_executor import KeyedExecutor, ChatDispatcher, JournalingQueue
+from engine.tg.tg_persistence import ThreadSafePicklePersistence
+from engine.tg.tg_request import CircuitBreaker, ResilientRequest, RetryBudget
+from engine.tg.tg_shutdown import ShutdownCoordinator
+from functools import partial
+from engine.tg.tg_webhook import create_webhook_server
+from telegram import Bot, Update, ChatMember, InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, \
+    InputTextMessageContent
 from telegram.ext import CallbackContext, Updater, CommandHandler, Filters, MessageHandler, ConversationHandler, \
-    CallbackQueryHandler, Dispatcher
-from telegram.error import BadRequest
-from threading import Event
+    CallbackQueryHandler, Dispatcher, JobQueue, Handler, InlineQueryHandler
+from telegram.error import BadRequest, ChatMigrated, Unauthorized
+from telegram.ext.utils.webhookhandler import WebhookServer
+from telegram.utils.request import Request
+from threading import Event, Thread
 from signal import SIGABRT, SIGINT, SIGTERM, signal
 
 """Consts for state selection within ConversationHandler"""
@@ -29,24 +41,117 @@ INITIAL_MSG_KEY = "initial_msg"
 INLINE_MSG_KEY = "inline_msg"
 HOURS_SPENT_KEY = "hours"
 
+"""Consts for bot data access"""
+MAINT_ID_KEY = "maint_id"
+GROUP_CACHE_KEY = "groups"
+GROUP_MEMBERS_KEY = "members"
+
+"""Handler groups processed before regular handlers: supergroup migration, then tracking group members"""
+MIGRATION_GROUP = -2
+TRACKING_GROUP = -1
+
+"""Error descriptions meaning that bot will not be able to reach the chat anymore"""
+DEAD_CHAT_ERRORS = ("kicked", "not found", "not a member", "deactivated")
+
 CALLBACK_DELIMITER = '#'
 
 
-def inform_all_chats(updater: Dispatcher, msg: str) -> None:
-    # Get all chats available
-    chat_ids = db.get_groups()
+def __migrate_group(bot_data: dict, old_chat_id: int, new_chat_id: int) -> None:
+    """ Move group data in DB and caches to new chat ID once group is converted to supergroup
+
+    :param bot_data: bot data of the dispatcher
+    :param old_chat_id: chat ID of the group
+    :param new_chat_id: chat ID of the supergroup
+    :return: null
+    """
+    if not db.migrate_group(old_chat_id, new_chat_id):
+        return
+    logging.info(f"Group {old_chat_id} is migrated to supergroup {new_chat_id}")
+
+    groups = bot_data[GROUP_CACHE_KEY]
+    if old_chat_id in groups:
+        groups[new_chat_id] = groups.pop(old_chat_id)
+    for chat_ids in list(bot_data[GROUP_MEMBERS_KEY].values()):
+        if old_chat_id in chat_ids:
+            chat_ids.discard(old_chat_id)
+            chat_ids.add(new_chat_id)
+
+
+def inform_all_chats(updater: ChatDispatcher, msg: str) -> None:
+    # Get all chats available (except dead ones)
+    with db.use_database(updater.database):
+        chat_ids = db.get_groups()
+        failing = set(db.get_failing_chats())
+
+    # DB connection is not held while messages are sent (sending might wait for flood control)
     for chat_id in chat_ids:
         try:
             # Inform users of bot activity without notification
-            updater.bot.send_message(chat_id=chat_id, text=msg, disable_notification=True)
-        except BadRequest as e:
-            # Chat might have been changed due to admin rights assignment, ignore such chats
+            try:
+                updater.bot.send_message(chat_id=chat_id, text=msg, disable_notification=True)
+            except ChatMigrated as e:
+                # Group has been converted to supergroup while migration message was missed
+                with db.use_database(updater.database):
+                    __migrate_group(updater.bot_data, chat_id, e.new_chat_id)
+                updater.bot.send_message(chat_id=e.new_chat_id, text=msg, disable_notification=True)
+            if chat_id in failing:
+                with db.use_database(updater.database):
+                    db.revive_chat(chat_id)
+        except (BadRequest, Unauthorized) as e:
+            # Chats that keep failing (bot is kicked, chat is removed) are skipped once marked as dead
+            if any(x in e.message.lower() for x in DEAD_CHAT_ERRORS):
+                with db.use_database(updater.database):
+                    db.record_chat_failure(chat_id, e.message)
             logging.warn(f'{chat_id} is not valid, reason: {e.message}')
 
 
 class CustomUpdater(Updater):
+
+    def start_dispatcher(self) -> None:
+        """ Start update processing without polling or own webhook listener (updates are fed by shared listener)
+
+        :return: null
+        """
+        dispatcher_ready = Event()
+        self._init_thread(self.dispatcher.start, "dispatcher", ready=dispatcher_ready)
+        self.running = True
+        dispatcher_ready.wait()
+        self.job_queue.start()
+
+
+class BotHost:
+    """ Runs several bots in a single process
+
+    Bots share worker pool, Bot API connection pool and webhook listener; handlers, chat data and DB are per bot.
+    """
     event: Event
 
+    def __init__(self, updaters: List[CustomUpdater]):
+        self.updaters = updaters
+        self.httpd: Optional[WebhookServer] = None
+
+    def start(self) -> None:
+        if global_params.POLLING_BASED:
+            for updater in self.updaters:
+                updater.start_polling(poll_interval=global_params.POLL_INTERVAL)
+            return
+
+        # Single listener for all bots, each bot is routed by its token in URL path
+        routes = {updater.bot.token: (updater.bot, updater.update_queue) for updater in self.updaters}
+        self.httpd = create_webhook_server(listen=global_params.LISTEN_IP, port=global_params.PORT, routes=routes,
+                                           key=global_params.PRIVATE_KEY, cert=global_params.CERTIFICATE)
+        Thread(target=self.httpd.serve_forever, name="webhook").start()
+
+        for updater in self.updaters:
+            updater.start_dispatcher()
+            webhook_url = f'https://{global_params.PUBLIC_IP}:{global_params.PORT}/{updater.bot.token}'
+            # Certificate is not uploaded if TLS is terminated by reverse proxy with a trusted certificate
+            if global_params.CERTIFICATE is None:
+                updater.bot.set_webhook(url=webhook_url)
+                continue
+            with open(global_params.CERTIFICATE, 'rb') as cert:
+                updater.bot.set_webhook(url=webhook_url, certificate=cert)
+
     def idle(self, stop_signals: Union[List, Tuple] = (SIGINT, SIGTERM, SIGABRT)) -> None:
 
         self.event = Event()
@@ -57,11 +162,54 @@ class CustomUpdater(Updater):
         self.event.wait()
 
     def _signal_handler(self, signum, frame) -> None:
-        if not global_params.DEBUG:
-            inform_all_chats(self.dispatcher, msgs.BOT_STOP)
-        super()._signal_handler(signum, frame)
+        # Shutdown itself is performed by main thread, signal handler only wakes it up
+        if self.event.is_set():
+            logging.warning("Exiting immediately!")
+            os._exit(1)
+        logging.info(f"Received signal {signum}, stopping...")
         self.event.set()
 
+    def shutdown(self, executor: KeyedExecutor, request: Request) -> None:
+        """ Stop bots within SHUTDOWN_DEADLINE
+
+        Intake is stopped first, then queued and in-flight updates are drained and state is flushed; stop broadcast
+        gets the remaining time. Updates that are not processed in time stay in journal and are replayed on startup.
+
+        :param executor: worker pool shared by all bots
+        :param request: Bot API connection pool shared by all bots
+        :return: null
+        """
+        coordinator = ShutdownCoordinator(global_params.SHUTDOWN_DEADLINE)
+
+        # Stopping updater passes updates remaining in its queue to executor
+        with coordinator.phase("intake"):
+            if self.httpd is not None:
+                self.httpd.shutdown()
+            coordinator.run_bounded({f"stop_{updater.dispatcher.bot_id}": updater.stop for updater in self.updaters})
+
+        with coordinator.phase("drain"):
+            drained = executor.shutdown(timeout=coordinator.remaining())
+
+        with coordinator.phase("flush"):
+            for updater in self.updaters:
+                dispatcher = updater.dispatcher
+                dispatcher.update_persistence()
+                dispatcher.persistence.flush()
+                # Connections of handlers that are still running (drain timed out) are left to them
+                if drained:
+                    dispatcher.database.close_all()
+                else:
+                    dispatcher.database.close_idle()
+
+        with coordinator.phase("broadcast"):
+            if not global_params.DEBUG:
+                coordinator.run_bounded({f"broadcast_{updater.dispatcher.bot_id}":
+                                         partial(inform_all_chats, updater.dispatcher, msgs.BOT_STOP)
+                                         for updater in self.updaters})
+
+        request.stop()
+        coordinator.report()
+
 
 def replay_message(chat_id: int, user_id: int, context: CallbackContext, log_msg: str, prompt: str, keyboard: InlineKeyboardMarkup):
     # Message in chat for user prompts and inline keyboard
@@ -168,7 +316,7 @@ def help(update: Update, context: CallbackContext) -> None:
         keyboard = [[InlineKeyboardButton(msgs.BUTTON_AUTHZ,
                                           callback_data=callback_data)]]
         markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=global_params.MAINT_ID, text=response, reply_markup=markup)
+        context.bot.send_message(chat_id=context.bot_data[MAINT_ID_KEY], text=response, reply_markup=markup)
 
     context.bot.send_message(chat_id=update.effective_chat.id, text=msgs.TG_HELP)
 
@@ -183,6 +331,109 @@ def unknown_cmd(update: Update, context: CallbackContext) -> None:
     context.bot.send_message(chat_id=update.effective_chat.id, text=msgs.TG_UNKNOWN)
 
 
+def __cache_group(context: CallbackContext, chat_id: int, **fields) -> None:
+    """ Update precomputed group summary used for inline queries
+
+    :param context: session info (prototype required by telegram-bot)
+    :param chat_id: unique key in DB
+    :param fields: title, balance and/or hour_fee to be updated
+    :return: null
+    """
+    context.bot_data[GROUP_CACHE_KEY].setdefault(chat_id, {"title": str(chat_id)}).update(fields)
+
+
+def __add_member(members: dict, chat_id: int, user_id: int) -> None:
+    """ Store group membership in DB and cache; DB is written only for memberships not seen before
+
+    :param members: group member cache (groups per user)
+    :param chat_id: unique key in DB
+    :param user_id: user seen in the group
+    :return: null
+    """
+    chat_ids = members.setdefault(user_id, set())
+    if chat_id not in chat_ids:
+        db.add_group_member(chat_id, user_id)
+        chat_ids.add(chat_id)
+
+
+def track_member(update: Update, context: CallbackContext) -> None:
+    """ Remember authorized groups the user is seen in, so that inline queries are answered without Bot API calls
+
+    Members and titles are stored in DB, so that they survive restart (in privacy mode users are seen rarely).
+
+    :param update: message info (prototype required by telegram-bot)
+    :param context: session info (prototype required by telegram-bot)
+    :return: null
+    """
+    chat = update.effective_chat
+    group = context.bot_data[GROUP_CACHE_KEY].get(chat.id)
+    if group is None:
+        return
+
+    members = context.bot_data[GROUP_MEMBERS_KEY]
+    if chat.title and group["title"] != chat.title:
+        db.set_group_title(chat.id, chat.title)
+        group["title"] = chat.title
+    if update.effective_user is not None:
+        __add_member(members, chat.id, update.effective_user.id)
+
+    message = update.effective_message
+    for user in message.new_chat_members:
+        __add_member(members, chat.id, user.id)
+        # Bot is added back to the group, so it is not dead anymore
+        if user.id == context.bot.id:
+            db.revive_chat(chat.id)
+    if message.left_chat_member is not None and chat.id in members.get(message.left_chat_member.id, set()):
+        db.remove_group_member(chat.id, message.left_chat_member.id)
+        members[message.left_chat_member.id].discard(chat.id)
+
+
+def migrate_group(update: Update, context: CallbackContext) -> None:
+    """ Move group data to new chat ID once group is converted to supergroup
+
+    Telegram notifies both the group (migrate_to_chat_id) and the supergroup (migrate_from_chat_id), whichever
+    is processed first moves the data.
+
+    :param update: message info (prototype required by telegram-bot)
+    :param context: session info (prototype required by telegram-bot)
+    :return: null
+    """
+    message = update.effective_message
+    if message.migrate_to_chat_id:
+        __migrate_group(context.bot_data, message.chat_id, message.migrate_to_chat_id)
+    else:
+        __migrate_group(context.bot_data, message.migrate_from_chat_id, message.chat_id)
+
+
+def balance_inline_query(update: Update, context: CallbackContext) -> None:
+    """ Provide balance and hour fee of user groups as inline query results
+
+    Results are served from the group cache and marked as personal, so that repeated queries are answered
+    by Telegram cache. Empty results are not cached.
+
+    :param update: message info (prototype required by telegram-bot)
+    :param context: session info (prototype required by telegram-bot)
+    :return: null
+    """
+    groups = context.bot_data[GROUP_CACHE_KEY]
+    # Member set is copied as it might be changed by member tracking of another chat meanwhile
+    chat_ids = list(context.bot_data[GROUP_MEMBERS_KEY].get(update.inline_query.from_user.id, set()))
+
+    results = []
+    for chat_id in chat_ids:
+        group = groups.get(chat_id)
+        if group is None:
+            continue
+        summary = msgs.TG_INLINE_BALANCE.format(balance=group["balance"], hour_fee=group["hour_fee"])
+        results.append(InlineQueryResultArticle(
+            id=str(chat_id), title=group["title"], description=summary,
+            input_message_content=InputTextMessageContent(f'{group["title"]}: {summary}')))
+
+    # Members are tracked in memory only, so empty result (e.g. right after restart) is not cached by Telegram
+    cache_time = global_params.INLINE_CACHE_TIME if results else 0
+    update.inline_query.answer(results, cache_time=cache_time, is_personal=True)
+
+
 def __get_balance(chat_id: int) -> str:
     """ Retrieve balance from DB based on chat_id
 
@@ -226,16 +477,19 @@ def get_balance_inline(update: Update, context: CallbackContext) -> str:
     return STATE_SELECTION
 
 
-def __add_balance(chat_id: int, deposit: int) -> str:
+def __add_balance(context: CallbackContext, update_id: int, chat_id: int, deposit: int) -> str:
     """ Increase balance and store it in DB based on chat_id
 
     Internal function to be used by command and conversation processors to interact with DB.
 
+    :param context: session info (prototype required by telegram-bot)
+    :param update_id: update that requested the change, applied only once if replayed
     :param chat_id: unique key in DB
     :param deposit: amount of credit debited
     :return: string with amount debited and available as a result
     """
-    balance = db.add_balance(chat_id, deposit)
+    balance = db.add_balance(chat_id, deposit, update_id)
+    __cache_group(context, chat_id, balance=balance)
     return msgs.TG_ADD_BALANCE.format(deposit=deposit, balance=balance)
 
 
@@ -267,7 +521,7 @@ def add_balance(update: Update, context: CallbackContext) -> None:
         context.bot.send_message(chat_id=chat_id, text=response)
         return
 
-    context.bot.send_message(chat_id=chat_id, text=__add_balance(chat_id, deposit))
+    context.bot.send_message(chat_id=chat_id, text=__add_balance(context, update.update_id, chat_id, deposit))
 
 
 def add_balance_inline(update: Update, context: CallbackContext) -> str:
@@ -313,24 +567,27 @@ def add_balance_inline_deposit(update: Update, context: CallbackContext) -> str:
         return STATE_ADD_BALANCE
 
     context.bot.delete_message(update.effective_chat.id, update.effective_message.message_id)
-    prompt = __add_balance(chat_id, deposit)
+    prompt = __add_balance(context, update.update_id, chat_id, deposit)
     replay_message(chat_id, user_id, context, prompt, prompt, default_keyboard())
 
     return STATE_SELECTION
 
 
-def __use_balance(chat_id: int, time: float, rent: int) -> str:
+def __use_balance(context: CallbackContext, update_id: int, chat_id: int, time: float, rent: int) -> str:
     """ Decrease balance in DB based on chat_id, rent fee and time spent
 
     Internal function to be used by command and conversation processors to interact with DB.
 
+    :param context: session info (prototype required by telegram-bot)
+    :param update_id: update that requested the change, applied only once if replayed
     :param chat_id: unique key in DB
     :param deposit: amount of credit debited
     :return: string with amount spent and available as a result
     """
     hour_fee = db.get_hour_fee(chat_id)
     spent = int(hour_fee * time) + rent
-    balance = db.use_balance(chat_id, spent)
+    balance = db.use_balance(chat_id, spent, update_id)
+    __cache_group(context, chat_id, balance=balance)
     return msgs.TG_USE_BALANCE.format(spent=spent, balance=balance)
 
 
@@ -369,7 +626,7 @@ def use_balance(update: Update, context: CallbackContext) -> None:
         context.bot.send_message(chat_id=chat_id, text=response)
         return
 
-    context.bot.send_message(chat_id=chat_id, text=__use_balance(chat_id, time, rent))
+    context.bot.send_message(chat_id=chat_id, text=__use_balance(context, update.update_id, chat_id, time, rent))
 
 
 def use_balance_inline(update: Update, context: CallbackContext) -> str:
@@ -455,7 +712,7 @@ def use_balance_inline_rent(update: Update, context: CallbackContext) -> str:
     context.bot.delete_message(update.effective_chat.id, update.effective_message.message_id)
     # Get hours spent from cache
     hours = context.chat_data[user_id].pop(HOURS_SPENT_KEY)
-    prompt = __use_balance(chat_id, hours, rent)
+    prompt = __use_balance(context, update.update_id, chat_id, hours, rent)
     replay_message(chat_id, user_id, context, prompt, prompt, default_keyboard())
 
     return STATE_USE_BALANCE_RENT
@@ -476,7 +733,7 @@ def authz_group(update: Update, context: CallbackContext) -> None:
     chat_id = update.effective_chat.id
 
     # If command is invoked manually from any chat except maintenance, delete violating message without notification
-    if chat_id != global_params.MAINT_ID:
+    if chat_id != context.bot_data[MAINT_ID_KEY]:
         context.bot.delete_message(chat_id=chat_id, message_id=update.effective_message.message_id)
         return
 
@@ -495,6 +752,7 @@ def authz_group(update: Update, context: CallbackContext) -> None:
         return
 
     if db.add_group(group_id):
+        __cache_group(context, group_id, balance=db.get_balance(group_id), hour_fee=db.get_hour_fee(group_id))
         context.bot.send_message(chat_id=group_id, text=msgs.TG_AUTHZ_COMPLETE)
 
 
@@ -506,20 +764,68 @@ def authz_group_inline(update: Update, context: CallbackContext) -> None:
     """
     cmd, group_id, group_name = update.callback_query.data.split(CALLBACK_DELIMITER)
     db.add_group(group_id)
+    __cache_group(context, int(group_id), title=group_name, balance=db.get_balance(group_id),
+                  hour_fee=db.get_hour_fee(group_id))
     context.bot.send_message(chat_id=group_id, text=msgs.TG_AUTHZ_COMPLETE)
     update.callback_query.edit_message_text(text=msgs.PROMPT_AUTHZ_GR_OK.format(group_name=group_name), reply_markup=None)
 
 
-def __set_hour_fee(chat_id: int, hour_fee: int) -> str:
+def profile(update: Update, context: CallbackContext) -> None:
+    """ Profile a sample of the next updates via maintenance chat
+
+    Profiles of the sampled updates are aggregated; the resulting cProfile dump is sent to maintenance chat once
+    the requested number of updates is profiled.
+
+    :param update: message info (prototype required by telegram-bot)
+    :param context: session info (prototype required by telegram-bot)
+    :return: null
+    """
+    chat_id = update.effective_chat.id
+
+    # If command is invoked manually from any chat except maintenance, delete violating message without notification
+    if chat_id != context.bot_data[MAINT_ID_KEY]:
+        context.bot.delete_message(chat_id=chat_id, message_id=update.effective_message.message_id)
+        return
+
+    # Check if the number of arguments is correct
+    if len(context.args) != 1:
+        response = msgs.TG_INVALID_ARG_NUM.format(num=1)
+        context.bot.send_message(chat_id=chat_id, text=response)
+        return
+
+    # Check if parameter is positive integer; otherwise, notify user
+    try:
+        count = int(context.args[0])
+        if count <= 0:
+            raise ValueError
+    except ValueError:
+        response = msgs.TG_INVALID_ARG_FMT.format(position=1)
+        context.bot.send_message(chat_id=chat_id, text=response)
+        return
+
+    bot = context.bot
+
+    # Called from the worker thread that completes profiling
+    def send_dump(path: str) -> None:
+        with open(path, 'rb') as dump:
+            bot.send_document(chat_id=chat_id, document=dump, caption=msgs.TG_PROFILE_DONE.format(count=count))
+
+    tracing.profiler.arm(count, global_params.PROFILE_SAMPLE_RATE, send_dump)
+    context.bot.send_message(chat_id=chat_id, text=msgs.TG_PROFILE_STARTED.format(count=count))
+
+
+def __set_hour_fee(context: CallbackContext, chat_id: int, hour_fee: int) -> str:
     """ Set hour fee in DB based on chat_id
 
     Internal function to be used by command and conversation processors to interact with DB.
 
+    :param context: session info (prototype required by telegram-bot)
     :param chat_id: unique key in DB
     :param hour_fee: hour fee
     :return: string with new fee set as a result
     """
     db.set_hour_fee(chat_id, hour_fee)
+    __cache_group(context, chat_id, hour_fee=hour_fee)
     return msgs.TG_HOUR_FEE_SET.format(sum=hour_fee)
 
 
@@ -557,7 +863,7 @@ def set_hour_fee(update: Update, context: CallbackContext) -> None:
         context.bot.send_message(chat_id=chat_id, text=response)
         return
 
-    context.bot.send_message(chat_id=chat_id, text=__set_hour_fee(chat_id, hour_fee))
+    context.bot.send_message(chat_id=chat_id, text=__set_hour_fee(context, chat_id, hour_fee))
 
 
 def set_hour_fee_inline(update: Update, context: CallbackContext) -> str:
@@ -613,8 +919,8 @@ def set_hour_fee_inline_value(update: Update, context: CallbackContext) -> str:
         return STATE_SET_HOUR_FEE
 
     context.bot.delete_message(update.effective_chat.id, update.effective_message.message_id)
-    context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=__set_hour_fee(chat_id, hour_fee),
-                                  reply_markup=default_keyboard())
+    context.bot.edit_message_text(chat_id=chat_id, message_id=message_id,
+                                  text=__set_hour_fee(context, chat_id, hour_fee), reply_markup=default_keyboard())
     return STATE_SELECTION
 
 
@@ -639,13 +945,42 @@ def finish_conversation(update: Update, context: CallbackContext) -> str:
     return STATE_END
 
 
-def start_bot() -> None:
-    """ Authenticate, authorize to Telegram; initialize handlers; start polling
+"""Bot methods available for regular authorized groups, listed in help"""
+REGISTERED_METHODS = (help, get_balance, add_balance, use_balance, set_hour_fee)
+
 
+def prune_journal(context: CallbackContext) -> None:
+    """ Remove processed updates from journal (repeating job)
+
+    :param context: job info (prototype required by telegram-bot)
     :return: null
     """
-    updater = CustomUpdater(token=global_params.TOKEN, use_context=True)
+    with db.use_database(context.dispatcher.database):
+        db.prune_journal(global_params.JOURNAL_RETENTION)
+
 
+def __trace_callbacks(handlers: Iterable[Handler]) -> None:
+    """ Wrap handler callbacks (including nested in conversations) to be recorded in update traces
+
+    :param handlers: registered handlers
+    :return: null
+    """
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            __trace_callbacks(handler.entry_points)
+            for state_handlers in handler.states.values():
+                __trace_callbacks(state_handlers)
+            __trace_callbacks(handler.fallbacks)
+        else:
+            handler.callback = tracing.traced(handler.callback)
+
+
+def register_handlers(dispatcher: Dispatcher) -> None:
+    """ Initialize handlers of a single bot
+
+    :param dispatcher: dispatcher of the bot
+    :return: null
+    """
     # Main menu handlers
     selection_handlers = [
         CallbackQueryHandler(finish_conversation, pattern=f"^{finish_conversation.__name__}$"),
@@ -685,7 +1020,10 @@ def start_bot() -> None:
     }
 
     # Button menu handler
+    # Conversation states are persisted, so that updates replayed after restart reach the same handler
     conv_handler = ConversationHandler(
+        name=start.__name__,
+        persistent=True,
         entry_points=[CommandHandler(start.__name__, start)],
         states={
             STATE_SELECTION: selection_handlers,
@@ -696,33 +1034,119 @@ def start_bot() -> None:
         },
         fallbacks=[CommandHandler(start.__name__, start)]
     )
-    updater.dispatcher.add_handler(conv_handler)
+    dispatcher.add_handler(conv_handler)
 
     # Maintenance direct command handlers (not visible in help)
-    updater.dispatcher.add_handler(CommandHandler(authz_group.__name__, authz_group))
-    updater.dispatcher.add_handler(CallbackQueryHandler(authz_group_inline,
-                                                        pattern=f"^{authz_group_inline.__name__}{CALLBACK_DELIMITER}"))
-
-    # Generate help prompt and handlers from bot methods available for regular authorized groups
-    registered_methods = (help, get_balance, add_balance, use_balance, set_hour_fee)
-    registered_names = [x.__name__ for x in registered_methods]
-    msgs.TG_HELP = msgs.TG_HELP % tuple(registered_names)
+    dispatcher.add_handler(CommandHandler(authz_group.__name__, authz_group))
+    dispatcher.add_handler(CommandHandler(profile.__name__, profile))
+    dispatcher.add_handler(CallbackQueryHandler(authz_group_inline,
+                                                pattern=f"^{authz_group_inline.__name__}{CALLBACK_DELIMITER}"))
 
-    for m in registered_methods:
-        updater.dispatcher.add_handler(CommandHandler(m.__name__, m))
+    # Handlers from bot methods available for regular authorized groups
+    for m in REGISTERED_METHODS:
+        dispatcher.add_handler(CommandHandler(m.__name__, m))
 
     # Unknown direct command handlers
     unknown_handler = MessageHandler(Filters.command, unknown_cmd)
-    updater.dispatcher.add_handler(unknown_handler)
+    dispatcher.add_handler(unknown_handler)
 
-    if global_params.POLLING_BASED:
-        updater.start_polling(poll_interval=global_params.POLL_INTERVAL)
-    else:
-        updater.start_webhook(listen=global_params.LISTEN_IP, port=global_params.PORT, url_path=global_params.TOKEN,
-                          key=global_params.PRIVATE_KEY, cert=global_params.CERTIFICATE,
-                          webhook_url=f'https://{global_params.PUBLIC_IP}:{global_params.PORT}/{global_params.TOKEN}')
+    # Inline mode balance queries, answered from group cache filled by member tracking
+    dispatcher.add_handler(MessageHandler(Filters.chat_type.groups, track_member), group=TRACKING_GROUP)
+
+    # Group to supergroup conversion changes chat ID
+    dispatcher.add_handler(MessageHandler(Filters.status_update.migrate, migrate_group), group=MIGRATION_GROUP)
+    dispatcher.add_handler(InlineQueryHandler(balance_inline_query))
+
+    if global_params.TRACING:
+        for group in dispatcher.groups:
+            __trace_callbacks(dispatcher.handlers[group])
+
+
+def bot_configs() -> List[dict]:
+    """ Parameters of bots hosted by the process
+
+    :return: list of dicts with TOKEN, MAINT_ID and DB_NAME
+    """
+    if global_params.BOTS:
+        return global_params.BOTS
+    return [{"TOKEN": global_params.TOKEN, "MAINT_ID": global_params.MAINT_ID, "DB_NAME": global_params.DB_NAME}]
+
+
+def create_updater(config: dict, executor: KeyedExecutor, request: Request) -> CustomUpdater:
+    """ Create updater of a single bot with its own handlers and DB
+
+    :param config: bot parameters (TOKEN, MAINT_ID, DB_NAME)
+    :param executor: worker pool shared by all bots
+    :param request: Bot API connection pool shared by all bots
+    :return: updater ready to be started
+    """
+    bot = Bot(token=config["TOKEN"], request=request)
+    job_queue = JobQueue()
+    # Conversation states and chat data are kept next to DB file
+    persistence = ThreadSafePicklePersistence(f"{os.path.splitext(config['DB_NAME'])[0]}.pickle")
+    database = db.open_database(config["DB_NAME"])
+    # Updates are journaled by the queue, before they are acknowledged to Telegram. Handlers are run by the shared
+    # executor and none of them is run_async, so dispatcher does not need own worker threads (PTB warns about it)
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="Asynchronous callbacks can not be processed")
+        dispatcher = ChatDispatcher(bot, JournalingQueue(database), workers=0, job_queue=job_queue,
+                                    persistence=persistence, use_context=True, executor=executor, database=database)
+    job_queue.set_dispatcher(dispatcher)
+    dispatcher.bot_data[MAINT_ID_KEY] = config["MAINT_ID"]
+
+    with db.use_database(dispatcher.database):
+        # DB might have been created by an older schema, tables added since then are created on startup
+        dispatcher.database.create_tables(db.MODELS, safe=True)
+        # Group cache for inline queries is precomputed from DB; titles and members are updated as updates arrive
+        groups = db.get_group_summaries()
+        dispatcher.bot_data[GROUP_MEMBERS_KEY] = db.get_group_members()
+    dispatcher.bot_data[GROUP_CACHE_KEY] = {chat_id: {"title": title or str(chat_id), "balance": balance,
+                                                      "hour_fee": hour_fee}
+                                            for chat_id, (title, balance, hour_fee) in groups.items()}
+
+    job_queue.run_repeating(prune_journal, interval=global_params.JOURNAL_PRUNE_INTERVAL)
+    register_handlers(dispatcher)
+    # Updater requires workers to be unset explicitly when dispatcher is provided
+    return CustomUpdater(dispatcher=dispatcher, workers=None)
+
+
+def start_bot() -> None:
+    """ Authenticate, authorize to Telegram; initialize handlers; start polling
+
+    :return: null
+    """
+    # Generate help prompt from bot methods available for regular authorized groups
+    msgs.TG_HELP = msgs.TG_HELP % tuple(x.__name__ for x in REGISTERED_METHODS)
+    tracing.init_tracing()
+
+    # Updates are processed in order per chat and in parallel across chats of all bots
+    executor = KeyedExecutor(workers=global_params.WORKERS, queue_size=global_params.CHAT_QUEUE_SIZE)
+    configs = bot_configs()
+    # Bot API connection pool is sized to worker count; PTB expects 4 more per bot for its own threads (long polling,
+    # job queue, etc.)
+    request = ResilientRequest(con_pool_size=global_params.WORKERS + 4 * len(configs),
+                               connect_timeout=global_params.CONNECT_TIMEOUT,
+                               read_timeout=global_params.READ_TIMEOUT,
+                               method_timeouts=global_params.METHOD_TIMEOUTS,
+                               max_retries=global_params.MAX_RETRIES,
+                               max_retry_after=global_params.MAX_RETRY_AFTER,
+                               retry_backoff=global_params.RETRY_BACKOFF,
+                               retry_budget=RetryBudget(global_params.RETRY_BUDGET, global_params.RETRY_BUDGET_PERIOD),
+                               breaker=CircuitBreaker(global_params.BREAKER_THRESHOLD,
+                                                      global_params.BREAKER_RESET_TIMEOUT),
+                               non_critical_methods=global_params.NON_CRITICAL_METHODS,
+                               deferred_queue_size=global_params.DEFERRED_QUEUE_SIZE)
+    host = BotHost([create_updater(config, executor, request) for config in configs])
+
+    executor.start()
+    # Updates interrupted by previous shutdown or crash are processed before new ones
+    for updater in host.updaters:
+        updater.dispatcher.replay_journal(global_params.REPLAY_MAX_AGE)
+    host.start()
 
     if not global_params.DEBUG:
-        inform_all_chats(updater.dispatcher, msgs.BOT_START)
+        for updater in host.updaters:
+            inform_all_chats(updater.dispatcher, msgs.BOT_START)
 
-    updater.idle()
+    host.idle()
+    host.shutdown(executor, request)
@@ -24,6 +24,9 @@ TG_AUTHZ_COMPLETE = "Группа авторизована"
 TG_NOT_ALLOWED = "Команда разрешена только администратору"
 TG_HOUR_FEE_SET = "Оплата за час установлена как {sum} RUB"
 TG_KEYBOARD_ACTIVE = "Другая клавиатура всё ещё активна"
+TG_PROFILE_STARTED = "Профилирование следующих {count} обновлений запущено"
+TG_PROFILE_DONE = "Профиль {count} обновлений"
+TG_INLINE_BALANCE = "Доступно {balance} RUB, час {hour_fee} RUB"
 
 BUTTON_START = "В начало"
 BUTTON_BALANCE = "Остаток"
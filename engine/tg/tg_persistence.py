@@ -0,0 +1,44 @@
+from typing import Optional, Tuple
+
+import os
+import pickle
+
+from telegram.ext import PicklePersistence
+from telegram.ext.utils.types import CD
+from threading import Lock
+
+
+class ThreadSafePicklePersistence(PicklePersistence):
+    """ Pickle persistence of conversation states and chat data that can be updated by several worker threads
+
+    Chat data is passed here already copied by BasePersistence, so the lock is sufficient to dump consistent state.
+    File is replaced atomically, so that a crash while dumping does not corrupt the previous state.
+    """
+
+    def __init__(self, filename: str):
+        super().__init__(filename, store_user_data=False, store_chat_data=True, store_bot_data=False)
+        self._lock = Lock()
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        with self._lock:
+            super().update_conversation(name, key, new_state)
+
+    def update_chat_data(self, chat_id: int, data: CD) -> None:
+        with self._lock:
+            super().update_chat_data(chat_id, data)
+
+    def flush(self) -> None:
+        with self._lock:
+            super().flush()
+
+    def _dump_singlefile(self) -> None:
+        data = {
+            'conversations': self.conversations,
+            'user_data': self.user_data,
+            'chat_data': self.chat_data,
+            'bot_data': self.bot_data,
+            'callback_data': self.callback_data,
+        }
+        with open(f"{self.filename}.tmp", "wb") as file:
+            pickle.dump(data, file)
+        os.replace(f"{self.filename}.tmp", self.filename)
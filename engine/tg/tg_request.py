@@ -0,0 +1,218 @@
+from collections import deque
+from time import monotonic, sleep
+from typing import Deque, Dict, Iterable, Optional, Tuple, Union
+
+import logging
+
+from engine.tracing import span
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.utils.request import Request
+from telegram.utils.types import JSONDict
+from threading import Condition, Lock, Thread
+
+"""Methods managed by PTB itself (long polling has its own timeout and retry loop)"""
+UNMANAGED_METHODS = {"getUpdates", "setWebhook", "deleteWebhook"}
+"""Methods that might be applied twice if retried after timeout (request might have reached Telegram)"""
+UNSAFE_RETRY_PREFIXES = ("send", "forward", "copy")
+"""Errors returned when a retried call has already been applied by the attempt that timed out, per method prefix"""
+ALREADY_APPLIED_ERRORS = {
+    "deleteMessage": "message to delete not found",
+    "editMessage": "message is not modified",
+    "pinChatMessage": "not modified"
+}
+
+
+class CircuitBreaker:
+    """ Fails Bot API calls fast while Telegram is unavailable
+
+    Breaker opens after threshold consecutive failures. Once reset_timeout expires, a single probe call is let
+    through: success closes the breaker, failure keeps it open for another reset_timeout.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._lock = Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    def available(self) -> bool:
+        """ Check if a call would be let through without reserving the probe """
+        with self._lock:
+            return self._opened_at is None or \
+                   (not self._probing and monotonic() >= self._opened_at + self._reset_timeout)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or monotonic() < self._opened_at + self._reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info("Bot API is available again, circuit breaker closed")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self._threshold:
+                if self._opened_at is None:
+                    logging.warning(f"Bot API is unavailable after {self._failures} failures, circuit breaker opened")
+                self._opened_at = monotonic()
+                self._probing = False
+
+
+class RetryBudget:
+    """ Token bucket limiting the number of retries across all calls to retries per period """
+
+    def __init__(self, retries: int, period: float):
+        self._capacity = retries
+        self._rate = retries / period
+        self._tokens = float(retries)
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> bool:
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class ResilientRequest(Request):
+    """ Bot API client with per-method timeouts, retries and circuit breaker
+
+    Connections are kept alive in a pool shared by all bots. RetryAfter is honored for every method, timeouts and
+    network errors are retried only for methods that are safe to repeat; all retries are limited by a shared budget.
+    While Telegram is unavailable, calls fail fast; non-critical calls are deferred and sent once it is back.
+    """
+
+    def __init__(self, con_pool_size: int, connect_timeout: float, read_timeout: float,
+                 method_timeouts: Dict[str, float], max_retries: int, max_retry_after: float,
+                 retry_backoff: float, retry_budget: RetryBudget, breaker: CircuitBreaker,
+                 non_critical_methods: Iterable[str], deferred_queue_size: int):
+        super().__init__(con_pool_size=con_pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout)
+        self._method_timeouts = method_timeouts
+        self._max_retries = max_retries
+        self._max_retry_after = max_retry_after
+        self._retry_backoff = retry_backoff
+        self._retry_budget = retry_budget
+        self._breaker = breaker
+        self._non_critical_methods = set(non_critical_methods)
+        # Oldest deferred calls are dropped once the queue is full
+        self._deferred: Deque[Tuple[str, JSONDict, Optional[float]]] = deque(maxlen=deferred_queue_size)
+        self._deferred_cond = Condition()
+        self._stopped = False
+        self._replay_thread = Thread(target=self._replay, name="deferred_api_calls", daemon=True)
+        self._replay_thread.start()
+
+    def __setattr__(self, key: str, value: object) -> None:
+        # Request warns on custom attributes, which is not applicable to subclasses
+        object.__setattr__(self, key, value)
+
+    def post(self, url: str, data: JSONDict, timeout: float = None) -> Union[JSONDict, bool]:
+        method = url.rsplit('/', 1)[-1]
+        if method in UNMANAGED_METHODS:
+            return super().post(url, data, timeout)
+
+        if timeout is None:
+            timeout = self._method_timeouts.get(method)
+
+        attempt = 0
+        # Call that failed with network error might have reached Telegram anyway
+        maybe_applied = False
+        while True:
+            if not self._breaker.allow():
+                return self._fail_fast(method, url, data, timeout)
+
+            try:
+                with span("api", method):
+                    result = super().post(url, data, timeout)
+                self._breaker.record_success()
+                return result
+            except RetryAfter as e:
+                # Telegram is available, but flood control is triggered
+                self._breaker.record_success()
+                if attempt >= self._max_retries or e.retry_after > self._max_retry_after \
+                        or not self._retry_budget.acquire():
+                    raise
+                logging.warning(f"{method} is rate limited, retrying in {e.retry_after}s")
+                sleep(e.retry_after)
+            except BadRequest as e:
+                self._breaker.record_success()
+                if maybe_applied and self._already_applied(method, e):
+                    logging.info(f"{method} has been applied by previous attempt")
+                    return True
+                raise
+            except NetworkError as e:
+                self._breaker.record_failure()
+                if attempt >= self._max_retries or method.startswith(UNSAFE_RETRY_PREFIXES) \
+                        or not self._retry_budget.acquire():
+                    if method in self._non_critical_methods and not self._breaker.available():
+                        return self._defer(method, url, data, timeout)
+                    raise
+                logging.warning(f"{method} failed ({e.message}), retrying")
+                maybe_applied = True
+                sleep(self._retry_backoff * 2 ** attempt)
+            except TelegramError:
+                # Any other response means Telegram is available
+                self._breaker.record_success()
+                raise
+            except Exception:
+                self._breaker.record_failure()
+                raise
+
+            attempt += 1
+
+    def stop(self) -> None:
+        with self._deferred_cond:
+            self._stopped = True
+            if self._deferred:
+                logging.warning(f"{len(self._deferred)} deferred Bot API calls are dropped")
+            self._deferred_cond.notify_all()
+        super().stop()
+
+    @staticmethod
+    def _already_applied(method: str, error: BadRequest) -> bool:
+        return any(method.startswith(prefix) and message in error.message.lower()
+                   for prefix, message in ALREADY_APPLIED_ERRORS.items())
+
+    def _fail_fast(self, method: str, url: str, data: JSONDict, timeout: Optional[float]) -> bool:
+        if method in self._non_critical_methods:
+            return self._defer(method, url, data, timeout)
+        raise NetworkError(f"Bot API is unavailable, {method} is not sent")
+
+    def _defer(self, method: str, url: str, data: JSONDict, timeout: Optional[float]) -> bool:
+        """ Queue non-critical call until Telegram is available; True is returned like for a successful call """
+        logging.info(f"Bot API is unavailable, {method} is deferred")
+        with self._deferred_cond:
+            self._deferred.append((url, data, timeout))
+            self._deferred_cond.notify()
+        return True
+
+    def _replay(self) -> None:
+        while True:
+            with self._deferred_cond:
+                # Breaker is reset by timeout, so availability is re-checked periodically
+                while not self._stopped and not (self._deferred and self._breaker.available()):
+                    self._deferred_cond.wait(timeout=1.0)
+                if self._stopped:
+                    return
+                url, data, timeout = self._deferred.popleft()
+
+            try:
+                self.post(url, data, timeout)
+            except TelegramError as e:
+                logging.warning(f"Deferred call {url.rsplit('/', 1)[-1]} failed: {e.message}")
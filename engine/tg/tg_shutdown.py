@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+from time import monotonic
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import logging
+
+from threading import Thread
+
+
+class ShutdownCoordinator:
+    """ Runs shutdown phases within a common deadline and reports time spent per phase """
+
+    def __init__(self, deadline: float):
+        self._deadline = deadline
+        self._started = monotonic()
+        self._timings: List[Tuple[str, float]] = []
+
+    def remaining(self) -> float:
+        return max(0.0, self._started + self._deadline - monotonic())
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self._timings.append((name, monotonic() - started))
+
+    def run_bounded(self, targets: Dict[str, Callable[[], None]]) -> bool:
+        """ Run targets in parallel and wait for them until deadline
+
+        Targets that are still running once deadline expires are abandoned (threads are daemonic).
+
+        :param targets: callables to be run per name
+        :return: True if all targets have finished in time
+        """
+        threads = []
+        for name, target in targets.items():
+            thread = Thread(target=self._run_logged, args=(name, target), name=f"shutdown_{name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join(self.remaining())
+
+        unfinished = [thread.name for thread in threads if thread.is_alive()]
+        if unfinished:
+            logging.warning(f"Shutdown deadline expired, abandoned: {', '.join(unfinished)}")
+        return not unfinished
+
+    def report(self) -> None:
+        phases = ", ".join(f"{name} {duration:.2f}s" for name, duration in self._timings)
+        logging.info(f"Shutdown completed in {monotonic() - self._started:.2f}s (deadline {self._deadline}s): {phases}")
+
+    @staticmethod
+    def _run_logged(name: str, target: Callable[[], None]) -> None:
+        try:
+            target()
+        except Exception:
+            logging.exception(f"Shutdown step {name} failed")
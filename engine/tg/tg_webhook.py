@@ -0,0 +1,44 @@
+from queue import Queue
+from typing import Dict, Optional, Tuple
+
+import ssl
+import tornado.web
+
+from telegram import Bot
+from telegram.error import TelegramError
+from telegram.ext.utils.webhookhandler import WebhookServer, WebhookHandler
+
+
+class MultiBotWebhookApp(tornado.web.Application):
+    """ Webhook application that routes Telegram calls to bots by URL path """
+
+    def __init__(self, routes: Dict[str, Tuple[Bot, Queue]]):
+        handlers = [(rf"/{url_path}/?", WebhookHandler, {"bot": bot, "update_queue": update_queue})
+                    for url_path, (bot, update_queue) in routes.items()]
+        tornado.web.Application.__init__(self, handlers)
+
+    def log_request(self, handler: tornado.web.RequestHandler) -> None:
+        pass
+
+
+def create_webhook_server(listen: str, port: int, routes: Dict[str, Tuple[Bot, Queue]],
+                          key: Optional[str] = None, cert: Optional[str] = None) -> WebhookServer:
+    """ Create single webhook listener shared by several bots
+
+    :param listen: IP address to start listener on
+    :param port: TCP port listener acquires from OS
+    :param routes: bot and its update queue per URL path
+    :param key: path to certificate private key
+    :param cert: path to certificate
+    :return: server to be run via serve_forever()
+    """
+    # Same as in Updater: certificate is used by listener only if key is present (otherwise reverse proxy does TLS)
+    ssl_ctx = None
+    if cert is not None and key is not None:
+        try:
+            ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_ctx.load_cert_chain(cert, key)
+        except ssl.SSLError as e:
+            raise TelegramError('Invalid SSL Certificate') from e
+
+    return WebhookServer(listen, port, MultiBotWebhookApp(routes), ssl_ctx)
@@ -0,0 +1,186 @@
+from contextlib import contextmanager
+from functools import wraps
+from logging.handlers import RotatingFileHandler
+from random import random
+from time import perf_counter, strftime
+from typing import Callable, Iterator, List, Optional
+
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+
+from engine import global_params
+
+"""Slow update traces are written as JSON lines via a dedicated logger"""
+_trace_log = logging.getLogger("oubot.traces")
+_local = threading.local()
+
+
+class Trace:
+    """ Spans recorded while a single update is processed """
+
+    def __init__(self, update_id: int, bot_id: str):
+        self.update_id = update_id
+        self.bot_id = bot_id
+        self.handlers: List[str] = []
+        self.spans: List[dict] = []
+        self.started = perf_counter()
+
+    def to_json(self, duration: float) -> str:
+        return json.dumps({
+            "time": strftime("%Y-%m-%dT%H:%M:%S"),
+            "bot_id": self.bot_id,
+            "update_id": self.update_id,
+            "handlers": self.handlers,
+            "duration": round(duration, 6),
+            "spans": self.spans
+        }, ensure_ascii=False)
+
+
+class SampledProfiler:
+    """ Profiles a sample of the next updates on demand and dumps aggregated stats to a file
+
+    Only one update is profiled at a time, concurrent updates are skipped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._busy = threading.Lock()
+        self._remaining = 0
+        self._rate = 1.0
+        self._stats: Optional[pstats.Stats] = None
+        self._on_complete: Optional[Callable[[str], None]] = None
+
+    def arm(self, count: int, rate: float, on_complete: Callable[[str], None]) -> None:
+        """ Start profiling of the next updates
+
+        :param count: number of updates to be profiled
+        :param rate: share of updates to be profiled, from 0 to 1
+        :param on_complete: called with path to the dump once count updates are profiled
+        """
+        with self._lock:
+            self._remaining = count
+            self._rate = rate
+            self._stats = None
+            self._on_complete = on_complete
+
+    def start(self) -> Optional[cProfile.Profile]:
+        with self._lock:
+            if self._remaining <= 0 or random() >= self._rate:
+                return None
+        if not self._busy.acquire(blocking=False):
+            return None
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile: cProfile.Profile) -> None:
+        profile.disable()
+        self._busy.release()
+
+        with self._lock:
+            # Profiling might have been completed or re-armed meanwhile
+            if self._remaining <= 0:
+                return
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self._remaining -= 1
+            if self._remaining > 0:
+                return
+
+            path = os.path.join(global_params.PROFILE_DIR, f"oubot_{strftime('%Y%m%d_%H%M%S')}.prof")
+            self._stats.dump_stats(path)
+            on_complete = self._on_complete
+
+        on_complete(path)
+
+
+profiler = SampledProfiler()
+
+
+def init_tracing() -> None:
+    """ Setup rotating JSONL file for slow update traces
+
+    :return: null
+    """
+    if not global_params.TRACING:
+        return
+
+    handler = RotatingFileHandler(global_params.TRACE_FILE, maxBytes=global_params.TRACE_FILE_SIZE,
+                                  backupCount=global_params.TRACE_FILE_COUNT, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _trace_log.addHandler(handler)
+    _trace_log.setLevel(logging.INFO)
+    _trace_log.propagate = False
+
+
+@contextmanager
+def trace_update(update_id: int, bot_id: str) -> Iterator[None]:
+    """ Record spans of the update processed by current thread; slow updates are written to trace file
+
+    :param update_id: Telegram update ID
+    :param bot_id: ID of the bot processing update
+    """
+    profile = profiler.start()
+    trace = Trace(update_id, bot_id) if global_params.TRACING else None
+    _local.trace = trace
+    try:
+        yield
+    finally:
+        _local.trace = None
+        if profile is not None:
+            profiler.stop(profile)
+        if trace is not None:
+            duration = perf_counter() - trace.started
+            if duration >= global_params.TRACE_THRESHOLD:
+                _trace_log.info(trace.to_json(duration))
+
+
+@contextmanager
+def span(kind: str, name: str) -> Iterator[None]:
+    """ Record time spent within the block as a span of the current update trace
+
+    :param kind: span type (api, db, handler)
+    :param name: Bot API method, SQL statement or handler name
+    """
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        yield
+        return
+
+    started = perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        record = {"kind": kind, "name": name, "start": round(started - trace.started, 6),
+                  "duration": round(perf_counter() - started, 6)}
+        if error is not None:
+            record["error"] = error
+        trace.spans.append(record)
+
+
+def traced(callback: Callable) -> Callable:
+    """ Wrap handler callback to record handler name and its span in the update trace
+
+    :param callback: handler callback
+    :return: wrapped callback
+    """
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            trace.handlers.append(callback.__name__)
+        with span("handler", callback.__name__):
+            return callback(*args, **kwargs)
+
+    return wrapper